@@ -1,13 +1,18 @@
+import json
 import logging
 import os
+import time
 from xml.etree.ElementTree import QName
 import numpy as np
+import qt
 import vtk
 
 import slicer
 from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 
+from SpineGuidanceStudyModuleLib import TrajectorySampling
+
 
 #
 # SpineGuidanceStudyModule
@@ -52,6 +57,7 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     ScriptedLoadableModuleWidget.__init__(self, parent)
     VTKObservationMixin.__init__(self)  # needed for parameter node observation
     self.logic = None
+    self.motionController = None
     self._parameterNode = None
     self._updatingGUIFromParameterNode = False
 
@@ -98,23 +104,29 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     self.ui.usVolumeComboBox.connect('currentNodeChanged(vtkMRMLNode*)', self.onUsVolumeSelected)
     self.ui.needleTransformComboBox.connect('currentNodeChanged(vtkMRMLNode*)', self.onNeedleTransformSelected)
 
-    # Translation
+    # Translation and rotation move the needle continuously while the button (or its key) is held
+
+    self.motionController = NeedleMotionController(self.logic, self.onNeedleMotion)
+    motionButtons = [
+      (self.ui.leftButton, self.logic.TRANSLATE_R, -1),
+      (self.ui.rightButton, self.logic.TRANSLATE_R, 1),
+      (self.ui.upButton, self.logic.TRANSLATE_S, 1),
+      (self.ui.downButton, self.logic.TRANSLATE_S, -1),
+      (self.ui.inButton, self.logic.NEEDLE_INSERTION, 1),
+      (self.ui.outButton, self.logic.NEEDLE_INSERTION, -1),
+      (self.ui.cranialRotationButton, self.logic.ROTATE_R, 1),
+      (self.ui.caudalRotationButton, self.logic.ROTATE_R, -1),
+      (self.ui.leftRotationButton, self.logic.ROTATE_S, -1),
+      (self.ui.rightRotationButton, self.logic.ROTATE_S, 1),
+    ]
+    for button, motionAxis, direction in motionButtons:
+      button.autoRepeat = False
+      button.connect('pressed()', lambda axis=motionAxis, sign=direction: self.motionController.startMotion(axis, sign))
+      button.connect('released()', lambda axis=motionAxis, sign=direction: self.motionController.stopMotion(axis, sign))
 
-    self.ui.leftButton.connect('clicked(bool)', self.onLeftButton)
-    self.ui.rightButton.connect('clicked(bool)', self.onRightButton)
-    self.ui.upButton.connect('clicked(bool)', self.onUpButton)
-    self.ui.downButton.connect('clicked(bool)', self.onDownButton)
-    self.ui.inButton.connect('clicked(bool)', self.onInButton)
-    self.ui.outButton.connect('clicked(bool)', self.onOutButton)
     self.ui.needleInLargeButton.connect('clicked(bool)', self.onInLargeButton)
     self.ui.needleOutLargeButton.connect('clicked(bool)', self.onOutLargeButton)
 
-    # Rotation
-    self.ui.cranialRotationButton.connect('clicked(bool)', self.onCranialRotationButton)
-    self.ui.caudalRotationButton.connect('clicked(bool)', self.onCaudalRotationButton)
-    self.ui.leftRotationButton.connect('clicked(bool)', self.onLeftRotationButton)
-    self.ui.rightRotationButton.connect('clicked(bool)', self.onRightRotationButton)
-
     # Slider changes
 
     self.ui.leftRightSlider.connect("valueChanged(double)", self.updateParameterNodeFromGUI)
@@ -168,6 +180,11 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     Called when the application closes and the module widget is destroyed.
     """
     self.removeObservers()
+    if self.logic is not None:
+      self.logic.removeObservers()
+    if self.motionController is not None:
+      self.motionController.setKeyboardEnabled(False)
+      self.motionController.stopAllMotion()
 
   def enter(self):
     """
@@ -177,6 +194,7 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     self.initializeParameterNode()
     # change to custom double 3D view here
     self.resetViews()
+    self.motionController.setKeyboardEnabled(True)
     
   def exit(self):
     """
@@ -184,6 +202,8 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     """
     # Do not react to parameter node changes (GUI wlil be updated when the user enters into the module)
     self.removeObserver(self._parameterNode, vtk.vtkCommand.ModifiedEvent, self.updateGUIFromParameterNode)
+    self.motionController.setKeyboardEnabled(False)
+    self.motionController.stopAllMotion()
 
   def onSceneStartClose(self, caller, event):
     """
@@ -274,8 +294,7 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     if usVolume is None:
       return
 
-    bounds = np.zeros(6)
-    usVolume.GetRASBounds(bounds)
+    bounds = self.logic.getVolumeGeometry(usVolume)["bounds"]
 
     # Update sliders to cover the volumem with extra margins
 
@@ -324,7 +343,10 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     displayNode = volumeRenderingLogic.GetFirstVolumeRenderingDisplayNode(selectedNode)
     if displayNode is None:
       selectedNode.CreateDefaultDisplayNodes()
-      slicer.modules.volumerendering.logic().CreateDefaultVolumeRenderingNodes(selectedNode) 
+      displayNode = volumeRenderingLogic.CreateDefaultVolumeRenderingNodes(selectedNode)
+      # Replace the default preset, which makes most ultrasound volumes unreadable.
+      # Existing display nodes are kept, they may have been saved in the scene or tuned by the participant.
+      self.logic.applyUltrasoundTransferFunction(selectedNode, displayNode)
     displayNode.SetViewNodeIDs([])  # Empty list means all views
 
     self.resetViews()
@@ -374,8 +396,7 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     if usVolume is None:
       self._parameterNode.SetParameter(self.logic.TRANSLATE_A, str(0))
     else:
-      bounds = np.zeros(6)
-      usVolume.GetRASBounds(bounds)
+      bounds = self.logic.getVolumeGeometry(usVolume)["bounds"]
       self._parameterNode.SetParameter(self.logic.TRANSLATE_A, str(bounds[2]))
 
     # update the transform
@@ -410,44 +431,38 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     viewNode.SetBoxVisible(False)
     viewNode.SetAxisLabelsVisible(False)
 
-  # Tranlation
-  def onRightButton(self):
-    self.ui.leftRightSlider.value = self.ui.leftRightSlider.value + self.logic.STEP_SIZE_TRANSLATION
-
-  def onLeftButton(self):
-    self.ui.leftRightSlider.value = self.ui.leftRightSlider.value - self.logic.STEP_SIZE_TRANSLATION
+  # Tranlation and rotation
+  def onNeedleMotion(self, motion):
+    """
+    Apply one frame of press-and-hold motion (parameter name -> change) in a single parameter node update.
+    Translations and rotations are kept within the slider ranges.
+    """
+    if self._parameterNode is None:
+      return
 
-  def onUpButton(self):
-    self.ui.upDownSlider.value = self.ui.upDownSlider.value + self.logic.STEP_SIZE_TRANSLATION
+    wasModified = self._parameterNode.StartModify()  # Modify all properties in a single batch
 
-  def onDownButton(self):
-    self.ui.upDownSlider.value = self.ui.upDownSlider.value - self.logic.STEP_SIZE_TRANSLATION
+    if self.logic.NEEDLE_INSERTION in motion:
+      self.logic.moveNeedleIn(motion[self.logic.NEEDLE_INSERTION], updateTransform=False)
+
+    for parameterName, slider in [(self.logic.TRANSLATE_R, self.ui.leftRightSlider),
+                                  (self.logic.TRANSLATE_S, self.ui.upDownSlider),
+                                  (self.logic.ROTATE_R, self.ui.cranialRotationSlider),
+                                  (self.logic.ROTATE_S, self.ui.leftRotationSlider)]:
+      if parameterName in motion:
+        value = float(self._parameterNode.GetParameter(parameterName)) + motion[parameterName]
+        value = min(max(value, slider.minimum), slider.maximum)
+        self._parameterNode.SetParameter(parameterName, str(value))
+    self.logic.updateTransformFromParameterNode()
 
-  def onInButton(self):
-    self.logic.moveNeedleIn(1)
+    self._parameterNode.EndModify(wasModified)
 
   def onInLargeButton(self):
     self.logic.moveNeedleIn(10)
 
-  def onOutButton(self):
-    self.logic.moveNeedleIn(-1)
-
   def onOutLargeButton(self):
     self.logic.moveNeedleIn(-10)
 
-  # Rotation
-  def onCranialRotationButton(self):
-    self.ui.cranialRotationSlider.value = self.ui.cranialRotationSlider.value + self.logic.STEP_SIZE_ROTATION
-
-  def onCaudalRotationButton(self):
-    self.ui.cranialRotationSlider.value = self.ui.cranialRotationSlider.value - self.logic.STEP_SIZE_ROTATION
-
-  def onLeftRotationButton(self):
-    self.ui.leftRotationSlider.value = self.ui.leftRotationSlider.value - self.logic.STEP_SIZE_ROTATION
-
-  def onRightRotationButton(self):
-    self.ui.leftRotationSlider.value = self.ui.leftRotationSlider.value + self.logic.STEP_SIZE_ROTATION
-
   # Saving results
   def onSaveDirectoryChanged(self, directory):
     # update settings with the new directory
@@ -469,15 +484,192 @@ class SpineGuidanceStudyModuleWidget(ScriptedLoadableModuleWidget, VTKObservatio
     self.logic.saveResults()
 
 
+#
+# NeedleMotionController
+#
+
+class NeedleMotionController(qt.QObject):
+  """
+  Moves the needle while motion buttons or keys are held.
+  Pressing moves one step immediately, like a single click. After a short hold, the velocity of each held axis
+  is accelerated and integrated at a fixed time step, and the motion of all axes is applied once per tick,
+  so the cost per rendered frame does not depend on how often button or key events arrive.
+  Ticks come from a precise timer at about the display frame rate (MOTION_TICK_INTERVAL_MS), not from the
+  render cycle itself. Views render once after each applied pose, and elapsed time is integrated in fixed steps,
+  so speed does not depend on timer jitter.
+  """
+
+  def __init__(self, logic, applyMotion):
+    """
+    applyMotion is called once per tick with a dict of parameter name -> change (mm or degrees).
+    """
+    qt.QObject.__init__(self)
+    self.logic = logic
+    self.applyMotion = applyMotion
+    self._keyboardEnabled = False
+    self._heldInputs = {}  # (motion axis, direction) -> number of buttons and keys holding it
+    self._heldKeys = set()  # (motion axis, direction) of keys held
+    self._heldDirections = {}  # Motion axis -> current direction of motion (+1 or -1)
+    self._heldTimes = {}  # Motion axis -> time held (s)
+    self._speeds = {}  # Motion axis -> current speed (mm/s or degrees/s)
+    self._pendingTime = 0.0
+    self._lastTickTime = None
+
+    self._timer = qt.QTimer()
+    self._timer.setTimerType(qt.Qt.PreciseTimer)
+    self._timer.setInterval(self.logic.MOTION_TICK_INTERVAL_MS)
+    self._timer.connect('timeout()', self.onTick)
+
+    self.keyMotions = {
+      qt.Qt.Key_A: (self.logic.TRANSLATE_R, -1),
+      qt.Qt.Key_D: (self.logic.TRANSLATE_R, 1),
+      qt.Qt.Key_W: (self.logic.TRANSLATE_S, 1),
+      qt.Qt.Key_S: (self.logic.TRANSLATE_S, -1),
+      qt.Qt.Key_E: (self.logic.NEEDLE_INSERTION, 1),
+      qt.Qt.Key_Q: (self.logic.NEEDLE_INSERTION, -1),
+      qt.Qt.Key_I: (self.logic.ROTATE_R, 1),
+      qt.Qt.Key_K: (self.logic.ROTATE_R, -1),
+      qt.Qt.Key_J: (self.logic.ROTATE_S, -1),
+      qt.Qt.Key_L: (self.logic.ROTATE_S, 1),
+    }
+
+  def startMotion(self, axis, direction):
+    self._heldInputs[(axis, direction)] = self._heldInputs.get((axis, direction), 0) + 1
+    if self._heldDirections.get(axis) == direction:
+      return
+    self._heldDirections[axis] = direction
+    self._heldTimes[axis] = 0.0
+    self._speeds[axis] = 0.0
+    self.applyMotion({axis: direction * self._getStepSize(axis)})
+    if not self._timer.isActive():
+      self._pendingTime = 0.0
+      self._lastTickTime = time.monotonic()
+      self._timer.start()
+
+  def stopMotion(self, axis, direction):
+    heldCount = self._heldInputs.get((axis, direction), 0)
+    if heldCount == 0:
+      return
+    if heldCount > 1:
+      self._heldInputs[(axis, direction)] = heldCount - 1  # Another button or key still holds it
+      return
+    del self._heldInputs[(axis, direction)]
+
+    if self._heldDirections.get(axis) == direction:
+      if (axis, -direction) in self._heldInputs:
+        # Fall back to the opposite direction, which is still held, without waiting for the hold delay again
+        self._heldDirections[axis] = -direction
+        self._heldTimes[axis] = self.logic.MOTION_HOLD_DELAY
+        self._speeds[axis] = 0.0
+      else:
+        del self._heldDirections[axis]
+
+    if not self._heldDirections:
+      self._timer.stop()
+
+  def stopAllMotion(self):
+    self._heldInputs.clear()
+    self._heldKeys.clear()
+    self._heldDirections.clear()
+    self._timer.stop()
+
+  def onTick(self):
+    """
+    Integrate held axes in fixed time steps for the time elapsed since the last tick, then apply the motion once.
+    """
+    now = time.monotonic()
+    timeStep = self.logic.MOTION_TICK_INTERVAL_MS / 1000.0
+    # Limit catching up after a stall (e.g. slow rendering) so that the needle does not jump
+    self._pendingTime = min(self._pendingTime + now - self._lastTickTime, self.logic.MOTION_MAX_STEPS_PER_TICK * timeStep)
+    self._lastTickTime = now
+
+    motion = {}
+    while self._pendingTime >= timeStep:
+      self._pendingTime -= timeStep
+      for axis, direction in self._heldDirections.items():
+        self._heldTimes[axis] += timeStep
+        if self._heldTimes[axis] < self.logic.MOTION_HOLD_DELAY:
+          continue
+        maxSpeed, acceleration = self._getSpeedLimits(axis)
+        self._speeds[axis] = min(self._speeds[axis] + acceleration * timeStep, maxSpeed)
+        motion[axis] = motion.get(axis, 0.0) + direction * self._speeds[axis] * timeStep
+
+    if motion:
+      self.applyMotion(motion)
+
+  def _getStepSize(self, axis):
+    if axis in [self.logic.ROTATE_R, self.logic.ROTATE_S]:
+      return self.logic.STEP_SIZE_ROTATION
+    return self.logic.STEP_SIZE_TRANSLATION
+
+  def _getSpeedLimits(self, axis):
+    if axis in [self.logic.ROTATE_R, self.logic.ROTATE_S]:
+      return self.logic.MOTION_MAX_SPEED_ROTATION, self.logic.MOTION_ACCELERATION_ROTATION
+    return self.logic.MOTION_MAX_SPEED_TRANSLATION, self.logic.MOTION_ACCELERATION_TRANSLATION
+
+  def setKeyboardEnabled(self, enabled):
+    """
+    Enable keyboard shortcuts for needle motion, application-wide (while the module is shown).
+    """
+    if enabled == self._keyboardEnabled:
+      return
+    self._keyboardEnabled = enabled
+    if enabled:
+      slicer.app.installEventFilter(self)
+    else:
+      slicer.app.removeEventFilter(self)
+
+  def eventFilter(self, obj, event):
+    if event.type() == qt.QEvent.ApplicationDeactivate:
+      self.stopAllMotion()  # Key release events would be missed
+      return False
+    if event.type() not in [qt.QEvent.KeyPress, qt.QEvent.KeyRelease] or event.key() not in self.keyMotions:
+      return False
+    motionKey = self.keyMotions[event.key()]
+
+    if event.type() == qt.QEvent.KeyRelease:
+      # Always stop held keys, even if focus moved to a text input or a modifier was pressed since
+      if motionKey not in self._heldKeys:
+        return False
+      if not event.isAutoRepeat():
+        self._heldKeys.remove(motionKey)
+        self.stopMotion(*motionKey)
+      return True
+
+    if motionKey in self._heldKeys:
+      return True  # Auto-repeat, motion continues until the key is released
+    if event.modifiers() != qt.Qt.NoModifier or self._isTextInputFocused():
+      return False
+    self._heldKeys.add(motionKey)
+    self.startMotion(*motionKey)
+    return True
+
+  def _isTextInputFocused(self):
+    """
+    Keys typed into text inputs must not move the needle.
+    """
+    focusWidget = slicer.app.focusWidget()
+    # Combo boxes include editable ones like ctkPathLineEdit, where the inner line edit passes focus to the combo box
+    return isinstance(focusWidget, (qt.QLineEdit, qt.QAbstractSpinBox, qt.QTextEdit, qt.QPlainTextEdit, qt.QComboBox))
+
 #
 # SpineGuidanceStudyModuleLogic
 #
 
-class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic):
+class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic, VTKObservationMixin):
   CURRENT_US_VOLUME = "CurrentUsVolume"
   MOTION_MARGIN = 100  # Allow needle to go outside image volume by this many mm
   STEP_SIZE_TRANSLATION = 1  # Translation single click in mm
   STEP_SIZE_ROTATION = 1  # Rotation single click in degrees
+  ROTATION_MINIMUM = -90  # Range of rotation sliders in degrees
+  ROTATION_MAXIMUM = 90
+  MOTION_TICK_INTERVAL_MS = 16  # Needle pose update interval while a motion button or key is held (about 60 fps)
+  MOTION_MAX_STEPS_PER_TICK = 4
+  MOTION_HOLD_DELAY = 0.3  # Continuous motion starts after holding a button or key for this many seconds
+  MOTION_MAX_SPEED_TRANSLATION = 20  # mm/s
+  MOTION_ACCELERATION_TRANSLATION = 40  # mm/s^2
+  MOTION_MAX_SPEED_ROTATION = 20  # degrees/s
+  MOTION_ACCELERATION_ROTATION = 40  # degrees/s^2
 
   NEEDLE_TO_RAS_TRANSFORM = "NeedleToRasTransform"
   NEEDLE_MODEL = "NeedleModel"
@@ -486,19 +678,35 @@ class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic):
   TRANSLATE_S = "TranslateS"
   ROTATE_R = "RotateR"
   ROTATE_S = "RotateS"
+  NEEDLE_INSERTION = "NeedleInsertion"  # Motion along the needle axis, not stored in the parameter node
 
   RESULTS_SAVE_DIRECTORY_SETTING = 'SpineGuidance/ResultsSaveDirectory'
   PARTICIPANT_ID = "ParticipantID"
   CURRENT_TASK_SETTING = 'SpineGuidance/CurrentTask'
   TASK_NAME = "TaskName"
 
+  TRAJECTORY_DEPTH = "TargetDepth"  # Distance (mm) from entry point to target along a candidate trajectory
+  TRAJECTORY_SCORE = "Score"
+  TRAJECTORY_ENTRY_ROTATE_R = 0  # ROTATE_R that points the needle anterior, into the volume from the posterior face
+  TRAJECTORY_SAMPLING_STEP = 1.0  # Distance between intensity samples along candidate trajectories in mm
+  TRAJECTORY_CHUNK_SIZE = 4096  # Number of candidate trajectories sampled in one batch, limits memory use
+
+  TRANSFER_FUNCTION_SAMPLE_COUNT = 1000000  # Number of voxels sampled to compute ultrasound intensity range
+  TRANSFER_FUNCTION_PERCENTILES = (30, 99.5)  # Opacity ramps from transparent at the first to maximum at the second
+  TRANSFER_FUNCTION_MAX_OPACITY = 0.8
+  INTENSITY_RANGES_FILENAME = "SpineGuidanceIntensityRanges.json"  # Saved in the folder of the current task
+
   def __init__(self):
     """
     Called when the logic class is instantiated. Can be used for initializing member variables.
     """
     ScriptedLoadableModuleLogic.__init__(self)
+    VTKObservationMixin.__init__(self)  # needed for volume geometry cache invalidation
     self.NEEDLE_TRANSFORM = "needle_RAStoNeedle"
     self.NEEDLE_TIP = "needleTip"
+    self._volumeGeometryCache = {}  # Volume geometry by volume node ID
+    self._trajectoryCache = {}  # Trajectory search results by volume node ID
+    self._intensityRangeCache = {}  # Ultrasound intensity range by volume node ID
 
   def setDefaultParameters(self, parameterNode):
     """
@@ -630,7 +838,11 @@ class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic):
     parameterNode.SetParameter(self.ROTATE_R, str(needleToRasOrientation[0] + 90))
     parameterNode.SetParameter(self.ROTATE_S, str(needleToRasOrientation[1]))
 
-  def moveNeedleIn(self, distance):
+  def moveNeedleIn(self, distance, updateTransform=True):
+    """
+    Move the needle along its axis. If updateTransform is False, only the parameter node is changed, so that
+    the caller can combine it with other motions in a single transform update.
+    """
     # Get the parameter node
     parameterNode = self.getParameterNode()
     # Get the transform node from the parameter node
@@ -646,7 +858,8 @@ class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic):
     parameterNode.SetParameter(self.TRANSLATE_A, str(float(parameterNode.GetParameter(self.TRANSLATE_A)) + Translation_RAS[1]))
     parameterNode.SetParameter(self.TRANSLATE_S, str(float(parameterNode.GetParameter(self.TRANSLATE_S)) + Translation_RAS[2]))
     # Update transform from Parameter Node
-    self.updateTransformFromParameterNode()
+    if updateTransform:
+      self.updateTransformFromParameterNode()
 
   def saveResults(self):
     ''' 
@@ -677,6 +890,350 @@ class SpineGuidanceStudyModuleLogic(ScriptedLoadableModuleLogic):
     # Save the NeedleToRasTransform to saveDirectory with fileName
     slicer.util.saveNode(needleToRasTransformNode, os.path.join(saveDirectory, fileName))
 
+  def findOptimalTrajectories(self, usVolume, target_RAS, numberOfTrajectories=5, boneMaskVolume=None,
+                              entryBounds=None, translationStep=2.0, rotationRange=30.0, rotationStep=2.0,
+                              targetTolerance=2.0, numberOfProcesses=1):
+    """
+    Search a grid of needle poses for the best paths from an entry region to a target point.
+    Entry points are placed on the posterior face of the volume (same as the needle reset position), within
+    entryBounds = [minR, maxR, minS, maxS] (defaults to the RAS bounds of the volume). Every combination of
+    TRANSLATE_R, TRANSLATE_S, ROTATE_R, ROTATE_S on the grid is kept if its line passes within targetTolerance mm
+    of the target. Kept lines are sampled from entry to target and ranked by the length of bone mask crossed
+    (if boneMaskVolume is given), then by the maximum intensity crossed.
+    Returns a list of at most numberOfTrajectories dicts with the pose parameters (keyed like the parameter node),
+    TRAJECTORY_DEPTH and TRAJECTORY_SCORE. Results are cached until the volume or the mask is modified.
+    """
+    if usVolume is None or usVolume.GetImageData() is None:
+      logging.warning("Trajectory search needs an ultrasound volume")
+      return []
+
+    target_RAS = np.array(target_RAS, dtype=float)
+    bounds = self.getVolumeGeometry(usVolume)["bounds"]
+    if entryBounds is None:
+      entryBounds = [bounds[0], bounds[1], bounds[4], bounds[5]]
+
+    # Return cached results if the search settings did not change. Cached results of a volume are removed
+    # together with its geometry when the volume or the mask is modified.
+
+    searchKey = (tuple(target_RAS), boneMaskVolume.GetID() if boneMaskVolume else None, tuple(entryBounds),
+                 translationStep, rotationRange, rotationStep, targetTolerance)
+    volumeCache = self._trajectoryCache.setdefault(usVolume.GetID(), {})
+    rankedTrajectories = volumeCache.get(searchKey)
+
+    if rankedTrajectories is None:
+      rankedTrajectories = self._searchTrajectories(usVolume, target_RAS, bounds[2], entryBounds, boneMaskVolume,
+                                                    translationStep, rotationRange, rotationStep, targetTolerance,
+                                                    numberOfProcesses)
+      volumeCache[searchKey] = rankedTrajectories
+
+    return [dict(trajectory) for trajectory in rankedTrajectories[:numberOfTrajectories]]
+
+  def _searchTrajectories(self, usVolume, target_RAS, entryA, entryBounds, boneMaskVolume,
+                          translationStep, rotationRange, rotationStep, targetTolerance, numberOfProcesses):
+    """
+    Evaluate all candidate trajectories in batched NumPy operations and return them sorted from best to worst.
+    """
+    # Build the grid of candidate poses
+
+    translationsR = np.arange(entryBounds[0], entryBounds[1] + translationStep / 2, translationStep)
+    translationsS = np.arange(entryBounds[2], entryBounds[3] + translationStep / 2, translationStep)
+    rotationsR = self._getRotationCandidates(self.TRAJECTORY_ENTRY_ROTATE_R, rotationRange, rotationStep)
+    rotationsS = self._getRotationCandidates(0, rotationRange, rotationStep)
+    gridR, gridS, gridRotationR, gridRotationS = [grid.ravel() for grid in np.meshgrid(
+      translationsR, translationsS, rotationsR, rotationsS, indexing='ij')]
+
+    entries_RAS = np.stack([gridR, np.full(gridR.shape, entryA), gridS], axis=1)
+
+    # Needle direction is the needle Z axis rotated the same way as in updateTransformFromParameterNode
+
+    rotationX = np.radians(gridRotationR - 90)
+    rotationY = np.radians(gridRotationS)
+    directions_RAS = np.stack([np.sin(rotationY),
+                               -np.sin(rotationX) * np.cos(rotationY),
+                               np.cos(rotationX) * np.cos(rotationY)], axis=1)
+
+    # Keep only candidates that pass close enough to the target, in front of the entry point
+
+    entryToTarget = target_RAS - entries_RAS
+    depths = np.einsum('ij,ij->i', entryToTarget, directions_RAS)
+    missDistances = np.linalg.norm(entryToTarget - depths[:, np.newaxis] * directions_RAS, axis=1)
+    candidates = np.flatnonzero((depths > 0) & (missDistances <= targetTolerance))
+    if candidates.size == 0:
+      logging.info("No candidate trajectory reaches the target")
+      return []
+
+    # Sample volumes along the remaining candidates, in chunks to limit memory use
+
+    volumeGeometry = self.getVolumeGeometry(usVolume)
+    voxels = volumeGeometry["voxels"]
+    rasToIjk = volumeGeometry["rasToIjk"]
+    maskVoxels = None
+    maskRasToIjk = None
+    if boneMaskVolume is not None:
+      maskGeometry = self.getVolumeGeometry(boneMaskVolume)
+      maskVoxels = maskGeometry["voxels"]
+      maskRasToIjk = maskGeometry["rasToIjk"]
+
+    numberOfProcesses = min(numberOfProcesses, candidates.size)
+    if numberOfProcesses > 1:
+      # One task per worker, volumes are sent to each worker once by the pool initializer
+      import concurrent.futures
+      chunks = np.array_split(candidates, numberOfProcesses)
+      with concurrent.futures.ProcessPoolExecutor(
+          max_workers=numberOfProcesses, initializer=TrajectorySampling.initializeWorker,
+          initargs=(voxels, rasToIjk, maskVoxels, maskRasToIjk)) as executor:
+        chunkScores = list(executor.map(
+          TrajectorySampling.scoreTrajectoriesInWorker,
+          [entries_RAS[chunk] for chunk in chunks], [directions_RAS[chunk] for chunk in chunks],
+          [depths[chunk] for chunk in chunks], [self.TRAJECTORY_SAMPLING_STEP] * len(chunks),
+          [self.TRAJECTORY_CHUNK_SIZE] * len(chunks)))
+      maximumIntensities = np.concatenate([scores[0] for scores in chunkScores])
+      boneLengths = np.concatenate([scores[1] for scores in chunkScores])
+    else:
+      maximumIntensities, boneLengths = TrajectorySampling.scoreTrajectories(
+        entries_RAS[candidates], directions_RAS[candidates], depths[candidates], self.TRAJECTORY_SAMPLING_STEP,
+        voxels, rasToIjk, maskVoxels, maskRasToIjk, self.TRAJECTORY_CHUNK_SIZE)
+
+    order = TrajectorySampling.rankTrajectories(missDistances[candidates], maximumIntensities, boneLengths)
+    scores = boneLengths if boneMaskVolume is not None else maximumIntensities
+
+    rankedTrajectories = []
+    for index in order:
+      candidate = candidates[index]
+      rankedTrajectories.append({
+        self.TRANSLATE_R: float(gridR[candidate]),
+        self.TRANSLATE_A: float(entryA),
+        self.TRANSLATE_S: float(gridS[candidate]),
+        self.ROTATE_R: float(gridRotationR[candidate]),
+        self.ROTATE_S: float(gridRotationS[candidate]),
+        self.TRAJECTORY_DEPTH: float(depths[candidate]),
+        self.TRAJECTORY_SCORE: float(scores[index]),
+      })
+    return rankedTrajectories
+
+  def _getRotationCandidates(self, centerRotation, rotationRange, rotationStep):
+    """
+    Rotations within rotationRange of centerRotation. The range is narrowed symmetrically around the center,
+    so that all rotations can be shown by the rotation sliders.
+    """
+    rotationRange = min(rotationRange, self.ROTATION_MAXIMUM - centerRotation, centerRotation - self.ROTATION_MINIMUM)
+    return centerRotation + np.arange(-rotationRange, rotationRange + rotationStep / 2, rotationStep)
+
+  def setNeedleTrajectory(self, trajectory, advanceToTarget=False):
+    """
+    Move the needle to the entry pose of a trajectory returned by findOptimalTrajectories.
+    If advanceToTarget is True, the needle is also inserted along the trajectory to the target.
+    """
+    parameterNode = self.getParameterNode()
+    wasModified = parameterNode.StartModify()
+    for parameterName in [self.TRANSLATE_R, self.TRANSLATE_A, self.TRANSLATE_S, self.ROTATE_R, self.ROTATE_S]:
+      parameterNode.SetParameter(parameterName, str(trajectory[parameterName]))
+    self.updateTransformFromParameterNode()
+    if advanceToTarget:
+      self.moveNeedleIn(trajectory[self.TRAJECTORY_DEPTH])
+    parameterNode.EndModify(wasModified)
+
+  def getVolumeGeometry(self, volumeNode):
+    """
+    Return the cached geometry of a volume, computing it on first access. The returned dict contains
+    "bounds" (RAS bounds), "spacing", "rasToIjk" and "ijkToRas" (4x4 NumPy arrays, including parent transforms)
+    and "voxels" (KJI-ordered NumPy view of the voxels, None if the volume has no image data).
+    The geometry is recomputed only after the volume is modified, transformed, or gets new image data.
+    """
+    volumeGeometry = self._volumeGeometryCache.get(volumeNode.GetID())
+    if volumeGeometry is not None:
+      return volumeGeometry
+
+    bounds = np.zeros(6)
+    volumeNode.GetRASBounds(bounds)
+    rasToIjk = self._getRasToIjkMatrix(volumeNode)
+    volumeGeometry = {
+      "bounds": bounds,
+      "spacing": np.array(volumeNode.GetSpacing()),
+      "rasToIjk": rasToIjk,
+      "ijkToRas": np.linalg.inv(rasToIjk),
+      "voxels": slicer.util.arrayFromVolume(volumeNode) if volumeNode.GetImageData() is not None else None,
+    }
+    self._volumeGeometryCache[volumeNode.GetID()] = volumeGeometry
+
+    # Scene is only observed once there is cached data to remove
+    if not self.hasObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAboutToBeRemovedEvent, self.onNodeAboutToBeRemoved):
+      self.addObserver(slicer.mrmlScene, slicer.mrmlScene.NodeAboutToBeRemovedEvent, self.onNodeAboutToBeRemoved)
+
+    for event in [vtk.vtkCommand.ModifiedEvent,
+                  slicer.vtkMRMLTransformableNode.TransformModifiedEvent,
+                  slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent]:
+      if not self.hasObserver(volumeNode, event, self.onVolumeGeometryModified):
+        self.addObserver(volumeNode, event, self.onVolumeGeometryModified)
+
+    return volumeGeometry
+
+  def onVolumeGeometryModified(self, caller, event):
+    """
+    Called when a volume with cached geometry is modified.
+    """
+    self.invalidateVolumeGeometry(caller)
+
+  @vtk.calldata_type(vtk.VTK_OBJECT)
+  def onNodeAboutToBeRemoved(self, caller, event, calldata):
+    """
+    Called before a node is removed from the scene, so cached data of removed volumes is not kept.
+    """
+    if calldata.GetID() in self._volumeGeometryCache:
+      self.invalidateVolumeGeometry(calldata)
+
+  def invalidateVolumeGeometry(self, volumeNode):
+    """
+    Remove cached geometry of a volume, and all cached results computed from it.
+    """
+    volumeID = volumeNode.GetID()
+    self._volumeGeometryCache.pop(volumeID, None)
+    self.removeObserver(volumeNode, vtk.vtkCommand.ModifiedEvent, self.onVolumeGeometryModified)
+    self.removeObserver(volumeNode, slicer.vtkMRMLTransformableNode.TransformModifiedEvent, self.onVolumeGeometryModified)
+    self.removeObserver(volumeNode, slicer.vtkMRMLVolumeNode.ImageDataModifiedEvent, self.onVolumeGeometryModified)
+
+    self._intensityRangeCache.pop(volumeID, None)
+
+    # Trajectory searches on this volume, or using this volume as bone mask
+    self._trajectoryCache.pop(volumeID, None)
+    for volumeCache in self._trajectoryCache.values():
+      for searchKey in [key for key in volumeCache if key[1] == volumeID]:
+        del volumeCache[searchKey]
+
+  def _getRasToIjkMatrix(self, volumeNode):
+    """
+    RAS to IJK matrix of a volume as a NumPy array, including the parent transform of the volume.
+    """
+    rasToIjk = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIjk)
+    transformNode = volumeNode.GetParentTransformNode()
+    if transformNode is not None:
+      if transformNode.IsTransformToWorldLinear():
+        worldToParent = vtk.vtkMatrix4x4()
+        transformNode.GetMatrixTransformFromWorld(worldToParent)
+        worldToIjk = vtk.vtkMatrix4x4()
+        vtk.vtkMatrix4x4.Multiply4x4(rasToIjk, worldToParent, worldToIjk)
+        rasToIjk = worldToIjk
+      else:
+        logging.warning("Non-linear transform of {} is ignored".format(volumeNode.GetName()))
+    return slicer.util.arrayFromVTKMatrix(rasToIjk)
+
+  def applyUltrasoundTransferFunction(self, volumeNode, volumeRenderingDisplayNode):
+    """
+    Set volume rendering transfer functions and slice view window/level from the ultrasound intensity range.
+    """
+    intensityRange = self.getUltrasoundIntensityRange(volumeNode)
+    if intensityRange is None:
+      return
+    lowIntensity, highIntensity = intensityRange
+
+    volumeProperty = volumeRenderingDisplayNode.GetVolumePropertyNode().GetVolumeProperty()
+    scalarOpacity = volumeProperty.GetScalarOpacity()
+    scalarOpacity.RemoveAllPoints()
+    scalarOpacity.AddPoint(lowIntensity, 0.0)
+    scalarOpacity.AddPoint(highIntensity, self.TRANSFER_FUNCTION_MAX_OPACITY)
+    colorTransfer = volumeProperty.GetRGBTransferFunction()
+    colorTransfer.RemoveAllPoints()
+    colorTransfer.AddRGBPoint(lowIntensity, 0.0, 0.0, 0.0)
+    colorTransfer.AddRGBPoint(highIntensity, 1.0, 1.0, 1.0)
+
+    # Automatic window/level would scan the full volume again
+    scalarDisplayNode = volumeNode.GetDisplayNode()
+    if scalarDisplayNode is not None:
+      scalarDisplayNode.AutoWindowLevelOff()
+      scalarDisplayNode.SetWindowLevelMinMax(lowIntensity, highIntensity)
+
+  def getUltrasoundIntensityRange(self, volumeNode):
+    """
+    Return (low, high) intensities for displaying an ultrasound volume, or None if the volume has no voxels.
+    The range is cached per volume. Ranges of volumes loaded from files are also saved in the folder of the
+    current task, so they are not recomputed when the same file is loaded again.
+    """
+    volumeID = volumeNode.GetID()
+    intensityRange = self._intensityRangeCache.get(volumeID)
+    if intensityRange is not None:
+      return intensityRange
+
+    voxels = self.getVolumeGeometry(volumeNode)["voxels"]
+    if voxels is None:
+      return None
+
+    savedRangeKey = self._getIntensityRangeKey(volumeNode)
+    savedRanges = self._loadIntensityRanges() if savedRangeKey is not None else {}
+    if savedRangeKey in savedRanges:
+      intensityRange = tuple(savedRanges[savedRangeKey])
+    else:
+      intensityRange = self._computeIntensityRange(voxels)
+      if savedRangeKey is not None:
+        savedRanges[savedRangeKey] = list(intensityRange)
+        self._saveIntensityRanges(savedRanges)
+
+    self._intensityRangeCache[volumeID] = intensityRange
+    return intensityRange
+
+  def _getIntensityRangeKey(self, volumeNode):
+    """
+    Identify the voxels of a volume by the file they were loaded from and its modification time.
+    Returns None if the volume was not loaded from a file, or its voxels changed since loading.
+    """
+    storageNode = volumeNode.GetStorageNode()
+    if storageNode is None or volumeNode.GetModifiedSinceRead():
+      return None
+    fileName = storageNode.GetFileName()
+    if not fileName or not os.path.exists(fileName):
+      return None
+    return "{}|{}".format(os.path.abspath(fileName), os.path.getmtime(fileName))
+
+  def _computeIntensityRange(self, voxels):
+    """
+    Robust intensity range from percentiles of a random voxel subsample, so large volumes are not fully scanned.
+    """
+    samples = voxels.ravel()
+    if samples.size > self.TRANSFER_FUNCTION_SAMPLE_COUNT:
+      # Random, not strided: a stride that is a multiple of the row length would only sample one column,
+      # which may be background outside the ultrasound sector. Seeded, so that the range is reproducible.
+      sampleIndices = np.random.default_rng(0).integers(0, samples.size, self.TRANSFER_FUNCTION_SAMPLE_COUNT)
+      samples = samples[sampleIndices]
+    backgroundIntensity = samples.min()
+    samples = samples[samples > backgroundIntensity]  # Ignore background outside the ultrasound sector
+    if samples.size == 0:
+      return (float(backgroundIntensity), float(backgroundIntensity) + 1.0)
+    lowIntensity, highIntensity = np.percentile(samples, self.TRANSFER_FUNCTION_PERCENTILES)
+    if highIntensity <= lowIntensity:
+      highIntensity = lowIntensity + 1.0
+    return (float(lowIntensity), float(highIntensity))
+
+  def _getIntensityRangesFilePath(self):
+    """
+    Path of the file storing intensity ranges next to the current task, or None if no task is selected.
+    """
+    settings = slicer.app.userSettings()
+    taskPath = settings.value(self.CURRENT_TASK_SETTING)
+    if not taskPath:
+      return None
+    return os.path.join(os.path.dirname(taskPath), self.INTENSITY_RANGES_FILENAME)
+
+  def _loadIntensityRanges(self):
+    filePath = self._getIntensityRangesFilePath()
+    if filePath is None or not os.path.exists(filePath):
+      return {}
+    try:
+      with open(filePath) as file:
+        return json.load(file)
+    except (OSError, ValueError) as e:
+      logging.warning("Could not read intensity ranges from {}: {}".format(filePath, e))
+      return {}
+
+  def _saveIntensityRanges(self, intensityRanges):
+    filePath = self._getIntensityRangesFilePath()
+    if filePath is None:
+      return
+    try:
+      with open(filePath, 'w') as file:
+        json.dump(intensityRanges, file, indent=2)
+    except OSError as e:
+      logging.warning("Could not save intensity ranges to {}: {}".format(filePath, e))
+
 #
 # SpineGuidanceStudyModuleTest
 #
@@ -697,8 +1254,250 @@ class SpineGuidanceStudyModuleTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
+    self.test_TrajectorySampling()
+    self.test_FindOptimalTrajectories()
+    self.test_VolumeGeometryCache()
+    self.test_IntensityRange()
+    self.test_NeedleMotionController()
     self.test_SpineGuidanceStudyModule1()
 
+  def test_TrajectorySampling(self):
+    """ Candidate lines are scored and ranked from synthetic volumes, without Slicer nodes.
+    """
+    self.delayDisplay("Starting trajectory sampling test")
+
+    # 20 mm cube with 1 mm voxels at the origin, one bright voxel and one mask voxel
+    voxels = np.zeros((20, 20, 20))
+    voxels[10, 5, 5] = 100  # KJI order: I=5, J=5, K=10
+    maskVoxels = np.zeros((20, 20, 20))
+    maskVoxels[10, 15, 15] = 1
+    rasToIjk = np.eye(4)
+
+    # Three parallel lines along S, the second one crosses the bright voxel, the third one the mask voxel
+    entries_RAS = np.array([[10.0, 10.0, 0.0], [5.0, 5.0, 0.0], [15.0, 15.0, 0.0]])
+    directions_RAS = np.array([[0.0, 0.0, 1.0]] * 3)
+    depths = np.array([15.0, 15.0, 15.0])
+
+    values = TrajectorySampling.sampleVolume(voxels, rasToIjk, np.array([[5.0, 5.0, 10.0], [-5.0, 0.0, 0.0]]))
+    self.assertEqual(values[0], 100)
+    self.assertTrue(np.isnan(values[1]))
+
+    maximumIntensities, maskLengths = TrajectorySampling.scoreTrajectories(
+      entries_RAS, directions_RAS, depths, 1.0, voxels, rasToIjk, maskVoxels, rasToIjk, chunkSize=2)
+    np.testing.assert_array_equal(maximumIntensities, [0, 100, 0])
+    np.testing.assert_array_equal(maskLengths, [0, 0, 1])
+
+    # Bright voxel beyond the target depth is not crossed
+    shortIntensities, _ = TrajectorySampling.scoreTrajectories(
+      entries_RAS[1:2], directions_RAS[1:2], np.array([5.0]), 1.0, voxels, rasToIjk)
+    self.assertEqual(shortIntensities[0], 0)
+
+    # Line crossing the bright voxel ranks last without a mask, line crossing the mask ranks last with a mask
+    missDistances = np.zeros(3)
+    order = TrajectorySampling.rankTrajectories(missDistances, maximumIntensities, np.zeros(3))
+    self.assertEqual(order[-1], 1)
+    order = TrajectorySampling.rankTrajectories(missDistances, maximumIntensities, maskLengths)
+    self.assertEqual(order[-1], 2)
+
+    # Worker processes give the same scores as the serial computation
+    TrajectorySampling.initializeWorker(voxels, rasToIjk, maskVoxels, rasToIjk)
+    workerIntensities, workerMaskLengths = TrajectorySampling.scoreTrajectoriesInWorker(
+      entries_RAS, directions_RAS, depths, 1.0, 4096)
+    np.testing.assert_array_equal(workerIntensities, maximumIntensities)
+    np.testing.assert_array_equal(workerMaskLengths, maskLengths)
+
+    # Candidate rotations are symmetric around the center, and limited to the slider range
+    logic = SpineGuidanceStudyModuleLogic()
+    np.testing.assert_array_equal(logic._getRotationCandidates(0, 30, 15), [-30, -15, 0, 15, 30])
+    np.testing.assert_array_equal(logic._getRotationCandidates(80, 30, 5), [70, 75, 80, 85, 90])
+
+    logic.removeObservers()
+    self.delayDisplay('Trajectory sampling test passed')
+
+  def test_FindOptimalTrajectories(self):
+    """ Trajectory search on a synthetic volume reaches a target inside it, and results are cached.
+    """
+    self.delayDisplay("Starting trajectory search test")
+
+    # 40 mm cube with 1 mm voxels, one bright voxel between the posterior face and the target
+    voxels = np.zeros((40, 40, 40))
+    voxels[20, 20, 10] = 100  # KJI order: R=10, A=20, S=20
+    usVolume = slicer.util.addVolumeFromArray(voxels, name="TrajectoryTestVolume")
+    target_RAS = np.array([20.0, 20.0, 20.0])
+    targetTolerance = 2.0
+
+    logic = SpineGuidanceStudyModuleLogic()
+    logic.setupScene()
+    logic.setDefaultParameters(logic.getParameterNode())
+
+    trajectories = logic.findOptimalTrajectories(usVolume, target_RAS, numberOfTrajectories=3, translationStep=4.0,
+                                                 rotationStep=3.0, targetTolerance=targetTolerance)
+    self.assertGreater(len(trajectories), 0)
+    self.assertEqual(trajectories[0][logic.TRAJECTORY_SCORE], 0)  # Best trajectories avoid the bright voxel
+
+    # Needle tip is inserted to the target
+    logic.setNeedleTrajectory(trajectories[0], advanceToTarget=True)
+    needleToRasTransformNode = logic.getParameterNode().GetNodeReference(logic.NEEDLE_TO_RAS_TRANSFORM)
+    needleTip_RAS = np.array(needleToRasTransformNode.GetTransformToParent().GetPosition())
+    self.assertLessEqual(np.linalg.norm(needleTip_RAS - target_RAS), targetTolerance)
+
+    # Same search is served from the cache
+    def failSearch(*args):
+      self.fail("Trajectory search was not cached")
+    logic._searchTrajectories = failSearch
+    cachedTrajectories = logic.findOptimalTrajectories(usVolume, target_RAS, numberOfTrajectories=3,
+                                                       translationStep=4.0, rotationStep=3.0,
+                                                       targetTolerance=targetTolerance)
+    self.assertEqual(cachedTrajectories, trajectories)
+
+    logic.removeObservers()
+    self.delayDisplay('Trajectory search test passed')
+
+  def test_VolumeGeometryCache(self):
+    """ Volume geometry is computed once, and recomputed only after the volume changes.
+    """
+    self.delayDisplay("Starting volume geometry cache test")
+
+    logic = SpineGuidanceStudyModuleLogic()
+
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(10, 10, 10)
+    imageData.AllocateScalars(vtk.VTK_FLOAT, 1)
+    imageData.GetPointData().GetScalars().Fill(0)
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLScalarVolumeNode')
+    volumeNode.SetAndObserveImageData(imageData)
+
+    geometry = logic.getVolumeGeometry(volumeNode)
+    np.testing.assert_allclose(geometry["bounds"], [-0.5, 9.5, -0.5, 9.5, -0.5, 9.5])
+    self.assertIs(logic.getVolumeGeometry(volumeNode), geometry)
+
+    # Spacing change
+    volumeNode.SetSpacing(2, 2, 2)
+    geometry = logic.getVolumeGeometry(volumeNode)
+    np.testing.assert_allclose(geometry["bounds"], [-1, 19, -1, 19, -1, 19])
+    np.testing.assert_allclose(np.diag(geometry["rasToIjk"])[:3], [0.5, 0.5, 0.5])
+    np.testing.assert_allclose(geometry["spacing"], [2, 2, 2])
+
+    # Parent transform
+    transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLLinearTransformNode')
+    parentToWorld = vtk.vtkMatrix4x4()
+    parentToWorld.SetElement(0, 3, 100)
+    transformNode.SetMatrixTransformToParent(parentToWorld)
+    volumeNode.SetAndObserveTransformNodeID(transformNode.GetID())
+    geometry = logic.getVolumeGeometry(volumeNode)
+    np.testing.assert_allclose(geometry["bounds"], [99, 119, -1, 19, -1, 19])
+    np.testing.assert_allclose(geometry["rasToIjk"] @ [100, 0, 0, 1], [0, 0, 0, 1], atol=1e-9)
+    np.testing.assert_allclose(geometry["ijkToRas"] @ [0, 0, 0, 1], [100, 0, 0, 1], atol=1e-9)
+
+    # New image data
+    newImageData = vtk.vtkImageData()
+    newImageData.SetDimensions(20, 20, 20)
+    newImageData.AllocateScalars(vtk.VTK_FLOAT, 1)
+    newImageData.GetPointData().GetScalars().Fill(0)
+    volumeNode.SetAndObserveImageData(newImageData)
+    geometry = logic.getVolumeGeometry(volumeNode)
+    self.assertEqual(geometry["voxels"].shape, (20, 20, 20))
+    np.testing.assert_allclose(geometry["bounds"], [99, 139, -1, 39, -1, 39])
+
+    # Removing the volume clears everything cached for it
+    volumeID = volumeNode.GetID()
+    logic.getUltrasoundIntensityRange(volumeNode)
+    logic.findOptimalTrajectories(volumeNode, [119, 19, 19], translationStep=10.0, rotationStep=10.0)
+    self.assertIn(volumeID, logic._intensityRangeCache)
+    self.assertIn(volumeID, logic._trajectoryCache)
+    slicer.mrmlScene.RemoveNode(volumeNode)
+    self.assertNotIn(volumeID, logic._volumeGeometryCache)
+    self.assertNotIn(volumeID, logic._intensityRangeCache)
+    self.assertNotIn(volumeID, logic._trajectoryCache)
+
+    logic.removeObservers()
+    self.delayDisplay('Volume geometry cache test passed')
+
+  def test_IntensityRange(self):
+    """ Ultrasound intensity range is computed from a voxel subsample, ignoring background.
+    """
+    self.delayDisplay("Starting intensity range test")
+
+    logic = SpineGuidanceStudyModuleLogic()
+
+    # Half of the voxels are background, tissue intensities are random in 1..100
+    voxels = np.zeros((20, 20, 50))
+    voxels[:, :, 25:] = np.random.default_rng(0).integers(1, 101, size=(20, 20, 25))
+    lowIntensity, highIntensity = logic._computeIntensityRange(voxels)
+    expectedLow, expectedHigh = np.percentile(voxels[:, :, 25:], logic.TRANSFER_FUNCTION_PERCENTILES)
+    self.assertAlmostEqual(lowIntensity, expectedLow, delta=2)
+    self.assertAlmostEqual(highIntensity, expectedHigh, delta=2)
+
+    # Subsampling a large volume gives about the same range
+    logic.TRANSFER_FUNCTION_SAMPLE_COUNT = 1000
+    subsampledLow, subsampledHigh = logic._computeIntensityRange(voxels)
+    self.assertAlmostEqual(subsampledLow, lowIntensity, delta=5)
+    self.assertAlmostEqual(subsampledHigh, highIntensity, delta=5)
+
+    # Tissue only in one half of each row, sample count that gives a stride of exactly one row
+    voxels = np.zeros((20, 20, 50))
+    voxels[:, :, 25:] = 50
+    logic.TRANSFER_FUNCTION_SAMPLE_COUNT = voxels.size // 50
+    lowIntensity, highIntensity = logic._computeIntensityRange(voxels)
+    self.assertEqual(lowIntensity, 50)
+
+    # Empty volume still gives a valid range
+    lowIntensity, highIntensity = logic._computeIntensityRange(np.zeros((5, 5, 5)))
+    self.assertLess(lowIntensity, highIntensity)
+
+    logic.removeObservers()
+    self.delayDisplay('Intensity range test passed')
+
+  def test_NeedleMotionController(self):
+    """ Press-and-hold motion is integrated at a fixed time step, simulating ticks without real events.
+    """
+    self.delayDisplay("Starting needle motion controller test")
+
+    logic = SpineGuidanceStudyModuleLogic()
+    motions = []
+    controller = NeedleMotionController(logic, motions.append)
+    timeStep = logic.MOTION_TICK_INTERVAL_MS / 1000.0
+
+    def simulateTicks(numberOfTicks):
+      for tick in range(numberOfTicks):
+        controller._lastTickTime -= timeStep
+        controller.onTick()
+
+    # Press moves one step immediately, then nothing until the hold delay
+    controller.startMotion(logic.TRANSLATE_R, 1)
+    self.assertEqual(motions, [{logic.TRANSLATE_R: logic.STEP_SIZE_TRANSLATION}])
+    simulateTicks(int(logic.MOTION_HOLD_DELAY / timeStep) - 2)
+    self.assertEqual(len(motions), 1)
+
+    # Held motion accelerates up to maximum speed, one motion per tick
+    simulateTicks(100)
+    self.assertEqual(controller._speeds[logic.TRANSLATE_R], logic.MOTION_MAX_SPEED_TRANSLATION)
+    maximumMotionPerTick = logic.MOTION_MAX_SPEED_TRANSLATION * timeStep * logic.MOTION_MAX_STEPS_PER_TICK
+    for motion in motions[1:]:
+      self.assertGreater(motion[logic.TRANSLATE_R], 0)
+      self.assertLessEqual(motion[logic.TRANSLATE_R], maximumMotionPerTick + 1e-9)
+
+    # A stall does not make the needle jump
+    controller._lastTickTime -= 10.0
+    controller.onTick()
+    self.assertLessEqual(motions[-1][logic.TRANSLATE_R], maximumMotionPerTick + 1e-9)
+
+    # Releasing the later of two opposite inputs falls back to the one still held
+    controller.startMotion(logic.TRANSLATE_R, -1)
+    self.assertEqual(controller._heldDirections[logic.TRANSLATE_R], -1)
+    controller.stopMotion(logic.TRANSLATE_R, -1)
+    self.assertEqual(controller._heldDirections[logic.TRANSLATE_R], 1)
+    controller.stopMotion(logic.TRANSLATE_R, 1)
+    self.assertNotIn(logic.TRANSLATE_R, controller._heldDirections)
+
+    numberOfMotions = len(motions)
+    simulateTicks(10)
+    self.assertEqual(len(motions), numberOfMotions)
+    controller.stopAllMotion()
+
+    logic.removeObservers()
+    self.delayDisplay('Needle motion controller test passed')
+
   def test_SpineGuidanceStudyModule1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
     tests should exercise the functionality of the logic with different inputs
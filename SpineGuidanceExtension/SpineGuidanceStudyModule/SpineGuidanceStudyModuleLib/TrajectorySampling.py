@@ -0,0 +1,82 @@
+"""
+Batched sampling and scoring of candidate needle trajectories.
+This module only depends on NumPy, so that worker processes can import it outside of Slicer.
+"""
+
+import numpy as np
+
+
+_workerVolumes = None  # Volume and mask of a worker process, set once by initializeWorker
+
+
+def sampleVolume(voxels, rasToIjk, points_RAS):
+  """
+  Nearest-neighbor sample a KJI-ordered voxel array at RAS points of shape (..., 3).
+  Points outside the volume are set to NaN.
+  """
+  points_IJK = points_RAS @ rasToIjk[:3, :3].T + rasToIjk[:3, 3]
+  indices = np.rint(points_IJK).astype(int)
+  inside = np.all((indices >= 0) & (indices < np.array(voxels.shape[::-1])), axis=-1)
+  values = np.full(points_RAS.shape[:-1], np.nan)
+  insideIndices = indices[inside]
+  values[inside] = voxels[insideIndices[:, 2], insideIndices[:, 1], insideIndices[:, 0]]
+  return values
+
+
+def scoreTrajectories(entries_RAS, directions_RAS, depths, samplingStep, voxels, rasToIjk,
+                      maskVoxels=None, maskRasToIjk=None, chunkSize=4096):
+  """
+  Sample lines from entry points to their target depths, chunkSize lines at a time to limit memory use.
+  Returns the maximum intensity crossed and the length (mm) crossed inside the mask for each line.
+  """
+  maximumIntensities = np.zeros(len(depths))
+  maskLengths = np.zeros(len(depths))
+  for start in range(0, len(depths), chunkSize):
+    chunk = slice(start, start + chunkSize)
+    maximumIntensities[chunk], maskLengths[chunk] = _scoreTrajectoryChunk(
+      entries_RAS[chunk], directions_RAS[chunk], depths[chunk], samplingStep,
+      voxels, rasToIjk, maskVoxels, maskRasToIjk)
+  return maximumIntensities, maskLengths
+
+
+def _scoreTrajectoryChunk(entries_RAS, directions_RAS, depths, samplingStep, voxels, rasToIjk,
+                          maskVoxels, maskRasToIjk):
+  distances = np.arange(int(np.ceil(depths.max() / samplingStep)) + 1) * samplingStep
+  points_RAS = entries_RAS[:, np.newaxis, :] + distances[np.newaxis, :, np.newaxis] * directions_RAS[:, np.newaxis, :]
+  onPath = distances[np.newaxis, :] <= depths[:, np.newaxis]
+
+  # Samples outside the volume count as no echo
+  intensities = np.nan_to_num(sampleVolume(voxels, rasToIjk, points_RAS), nan=0.0)
+  maximumIntensities = np.where(onPath, intensities, 0.0).max(axis=1)
+
+  maskLengths = np.zeros(len(depths))
+  if maskVoxels is not None:
+    inMask = np.nan_to_num(sampleVolume(maskVoxels, maskRasToIjk, points_RAS), nan=0.0) > 0
+    maskLengths = np.count_nonzero(inMask & onPath, axis=1) * samplingStep
+
+  return maximumIntensities, maskLengths
+
+
+def rankTrajectories(missDistances, maximumIntensities, maskLengths):
+  """
+  Return indices of trajectories from best to worst: least mask crossed first, then lowest maximum intensity,
+  then closest to the target.
+  """
+  return np.lexsort((missDistances, maximumIntensities, maskLengths))
+
+
+def initializeWorker(voxels, rasToIjk, maskVoxels, maskRasToIjk):
+  """
+  Process pool initializer, so that volumes are sent to each worker process only once.
+  """
+  global _workerVolumes
+  _workerVolumes = (voxels, rasToIjk, maskVoxels, maskRasToIjk)
+
+
+def scoreTrajectoriesInWorker(entries_RAS, directions_RAS, depths, samplingStep, chunkSize):
+  """
+  Same as scoreTrajectories, using the volumes set by initializeWorker.
+  """
+  voxels, rasToIjk, maskVoxels, maskRasToIjk = _workerVolumes
+  return scoreTrajectories(entries_RAS, directions_RAS, depths, samplingStep, voxels, rasToIjk,
+                           maskVoxels, maskRasToIjk, chunkSize)